@@ -1,11 +1,51 @@
 import numpy as np
 from scipy.special import jv # Bessel Function of the first kind
 from scipy.linalg import eig
-from scipy.fftpack import fftn, ifftn, ifft
 # import progressbar
 from tqdm import tqdm
 from scipy.ndimage import filters as fi
+import functools
 import math
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyfftw
+    import pyfftw.builders
+    HAS_PYFFTW = True
+except ImportError:
+    HAS_PYFFTW = False
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    import numexpr as ne
+    HAS_NUMEXPR = True
+except ImportError:
+    HAS_NUMEXPR = False
+
+try:
+    import cupy
+    HAS_CUPY = True
+except ImportError:
+    HAS_CUPY = False
+
+NUMPY_LESS_1_8 = np.lib.NumpyVersion(np.__version__) < '1.8.0'
+
+# FFTW wisdom is persisted here so the plans measured for an image shape
+# are imported immediately by later runs
+FFTW_WISDOM_FILE = os.environ.get('RIVULET_FFTW_WISDOM',
+                                  os.path.join(os.path.expanduser('~'), '.rivuletpy_fftw_wisdom'))
+FFTW_PLANNER_EFFORT = 'FFTW_MEASURE' # 'FFTW_PATIENT' pays off once the wisdom is kept
+EIGVAL33_TILE = 32768 # Voxels per block, small enough for the working set of a block to stay in cache
+# The fastmath flags of the numba eigenvalue kernels without 'arcp', since replacing the
+# divisions by reciprocal multiplies leaves a residual for isotropic tensors in float32
+EIGVAL33_FASTMATH = {'nnan', 'ninf', 'nsz', 'contract', 'afn', 'reassoc'}
 
 # An implementation of the Optimally Oriented 
 # M.W.K. Law and A.C.S. Chung, ``Three Dimensional Curvilinear 
@@ -17,91 +57,125 @@ import math
 
 def response(img, rsptype='oof', **kwargs):
     eps = 1e-12
-    rsp = np.zeros(img.shape)
+    use_gpu = kwargs.get('use_gpu', False) # Run the per-radius computation with cupy
+    workers = kwargs.get('workers', 1) # The number of radii to process concurrently
+    xp = _array_module(use_gpu)
+    img = np.ascontiguousarray(img, dtype='float32') # Single precision is enough for the responses
+    rsp = np.zeros(img.shape, dtype='float32')
     # bar = progressbar.ProgressBar(max_value=kwargs['radii'].size)
     # bar.update(0)
 
-    W = np.zeros((img.shape[0], img.shape[1], img.shape[2], 3)) # Eigen values to save
-    V = np.zeros((img.shape[0], img.shape[1], img.shape[2], 3, 3)) # Eigen vectors to save
+    W = np.zeros((img.shape[0], img.shape[1], img.shape[2], 3), dtype='float32') # Eigen values to save
+    V = np.zeros((img.shape[0], img.shape[1], img.shape[2], 3, 3), dtype='float32') # Eigen vectors to save
 
     if rsptype == 'oof' :
-        rsptensor = ooftensor(img, kwargs['radii'], kwargs['memory_save'])
+        rsptensor = ooftensor(img, kwargs['radii'], kwargs['memory_save'], use_gpu)
     elif rsptype == 'bg':
-        rsptensor = bgtensor(img, kwargs['radii'], kwargs['rho'])
+        rsptensor = bgtensor(img, kwargs['radii'], kwargs['rho'], use_gpu)
 
+    # Each radius is independent until the running maximum, so up to workers
+    # radii are decomposed in threads while the next tensor is being computed
     pbar = tqdm(total=len(kwargs['radii']))
-    for i, tensorfield in enumerate(rsptensor):
-        # Make the tensor from tensorfield
-        f11, f12, f13, f22, f23, f33 = tensorfield
-        tensor = np.stack((f11, f12, f13, f12, f22, f23, f13, f23, f33), axis=-1)
-        del f11
-        del f12
-        del f13
-        del f22
-        del f23
-        del f33
-        tensor = tensor.reshape(img.shape[0], img.shape[1], img.shape[2], 3, 3)
-        w, v = np.linalg.eigh(tensor)
-        del tensor
-        sume = w.sum(axis=-1)
-        nvox = img.shape[0] * img.shape[1] * img.shape[2]
-        sortidx = np.argsort(np.abs(w), axis=-1)
-        sortidx = sortidx.reshape((nvox, 3))
-
-        # Sort eigenvalues according to their abs
-        w = w.reshape((nvox, 3))
-        for j, (idx, value) in enumerate(zip(sortidx, w)):
-            w[j,:] = value[idx]
-        w = w.reshape(img.shape[0], img.shape[1], img.shape[2], 3)
-
-        # Sort eigenvectors according to their abs
-        v = v.reshape((nvox, 3, 3))
-        for j, (idx, vec) in enumerate(zip(sortidx, v)):
-            v[j,:,:] = vec[:, idx]
-        del sortidx
-        v = v.reshape(img.shape[0], img.shape[1], img.shape[2], 3, 3)
-
-        mine = w[:,:,:, 0]
-        mide = w[:,:,:, 1]
-        maxe = w[:,:,:, 2]
-
-        if rsptype == 'oof':
-            feat = maxe
-        elif rsptype == 'bg':
-            feat = -mide / maxe * (mide + maxe) # Medialness measure response
-            cond = sume >= 0
-            feat[cond] = 0 # Filter the non-anisotropic voxels
-
-        del mine
-        del maxe
-        del mide
-        del sume
-
-        cond = np.abs(feat) > np.abs(rsp)
-        W[cond, :] = w[cond, :]
-        V[cond, :, :] = v[cond, :, :]
-        rsp[cond] = feat[cond]
-        del v
-        del w
-        del tensorfield
-        del feat
-        del cond
-        pbar.update(1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for tensorfield in rsptensor:
+            pending.append(executor.submit(_radius_response, tensorfield, rsptype, xp))
+            del tensorfield
+            if len(pending) >= workers:
+                _update_response(rsp, W, V, *pending.popleft().result())
+                pbar.update(1)
+
+        while pending: # Reduce in the order of radii
+            _update_response(rsp, W, V, *pending.popleft().result())
+            pbar.update(1)
 
     return rsp, V, W
 
 
+def _radius_response(tensorfield, rsptype, xp):
+    '''
+    The filter response and its sorted eigen decomposition at a single radius
+    '''
+    shape = tensorfield[0].shape
+
+    # Make the tensor from tensorfield
+    # Only the lower triangle is filled since eigh does not read the upper one
+    f11, f12, f13, f22, f23, f33 = tensorfield
+    tensor = xp.zeros((shape[0], shape[1], shape[2], 3, 3), dtype=f11.dtype)
+    tensor[:, :, :, 0, 0] = f11
+    tensor[:, :, :, 1, 0] = f12
+    tensor[:, :, :, 2, 0] = f13
+    tensor[:, :, :, 1, 1] = f22
+    tensor[:, :, :, 2, 1] = f23
+    tensor[:, :, :, 2, 2] = f33
+    del f11
+    del f12
+    del f13
+    del f22
+    del f23
+    del f33
+    w, v = xp.linalg.eigh(tensor, UPLO='L') # One batched LAPACK ?syevd call
+    del tensor
+    sume = w.sum(axis=-1)
+    nvox = shape[0] * shape[1] * shape[2]
+    sortidx = xp.argsort(xp.abs(w), axis=-1)
+    sortidx = sortidx.reshape((nvox, 3))
+    voxidx = xp.arange(nvox)[:, np.newaxis]
+
+    # Sort eigenvalues according to their abs
+    w = w.reshape((nvox, 3))[voxidx, sortidx]
+    w = w.reshape(shape[0], shape[1], shape[2], 3)
+
+    # Sort eigenvectors (the columns of v) according to their abs
+    v = v.reshape((nvox, 3, 3))[voxidx[:, :, np.newaxis],
+                                xp.arange(3)[np.newaxis, :, np.newaxis],
+                                sortidx[:, np.newaxis, :]]
+    del sortidx
+    del voxidx
+    v = v.reshape(shape[0], shape[1], shape[2], 3, 3)
+
+    mine = w[:,:,:, 0]
+    mide = w[:,:,:, 1]
+    maxe = w[:,:,:, 2]
+
+    if rsptype == 'oof':
+        feat = maxe
+    elif rsptype == 'bg':
+        # Medialness measure response with the non-anisotropic voxels filtered
+        feat = xp.where(sume >= 0, 0, -mide / maxe * (mide + maxe))
+
+    del mine
+    del maxe
+    del mide
+    del sume
+
+    # Bring the results of this radius back to the host
+    return _asnumpy(feat), _asnumpy(w), _asnumpy(v)
+
+
+def _update_response(rsp, W, V, feat, w, v):
+    '''
+    Keep the response with the largest magnitude and its eigen decomposition
+    '''
+    cond = np.abs(feat) > np.abs(rsp)
+    np.copyto(W, w, where=cond[:, :, :, np.newaxis])
+    np.copyto(V, v, where=cond[:, :, :, np.newaxis, np.newaxis])
+    np.copyto(rsp, feat, where=cond)
+
+
+@functools.lru_cache(maxsize=64)
 def bgkern3(kerlen, mu=0, sigma=3., rho=0.2):
     '''
     Generate the bi-gaussian kernel
+    The kernels are cached by their parameters and returned read-only
     '''
     sigma_b = rho * sigma
     k = rho ** 2
     kr = (kerlen - 1) / 2 
     X, Y, Z = np.meshgrid(np.arange(-kr, kr+1),
                           np.arange(-kr, kr+1), 
-                          np.arange(-kr, kr+1))
-    dist = np.linalg.norm(np.stack((X, Y, Z)), axis=0) 
+                          np.arange(-kr, kr+1), sparse=True)
+    dist = np.sqrt(X ** 2 + Y ** 2 + Z ** 2) # Broadcast from the sparse axes
 
     G  = gkern3(dist, mu, sigma) # Normal Gaussian with mean at origin
     Gb = gkern3(dist, sigma-sigma_b, sigma_b)
@@ -114,10 +188,8 @@ def bgkern3(kerlen, mu=0, sigma=3., rho=0.2):
     # Replace the centre of Gb with G
     central_region = dist <= sigma
     del dist
-    X = (X[central_region] + kr).astype('int')
-    Y = (Y[central_region] + kr).astype('int')
-    Z = (Z[central_region] + kr).astype('int')
-    Gb[X, Y, Z] = G[X, Y, Z]
+    Gb[central_region] = G[central_region]
+    Gb.flags.writeable = False # Shared by every caller through the cache
 
     return Gb
 
@@ -174,165 +246,577 @@ def hessian3(x):
     """
     Calculate the hessian matrix with finite differences
     Parameters:
-       - x : ndarray
+       - x : ndarray or cupy.ndarray
     Returns:
        an array of shape (x.dim, x.ndim) + x.shape
        where the array[i, j, ...] corresponds to the second derivative x_ij
     """
-    x_grad = np.gradient(x)
-    tmpgrad = np.gradient(x_grad[0])
-    f11 = tmpgrad[0]
-    f12 = tmpgrad[1]
-    f13 = tmpgrad[2]
-    tmpgrad = np.gradient(x_grad[1])
-    f22 = tmpgrad[1]
-    f23 = tmpgrad[2]
-    tmpgrad = np.gradient(x_grad[2])
-    f33 = tmpgrad[2]
+    xp = _get_array_module(x)
+    dtype = np.result_type(x.dtype, np.float32)
+    grad = xp.empty(x.shape, dtype=dtype) # Shared by the three first derivatives
+    f11, f12, f13, f22, f23, f33 = [xp.empty(x.shape, dtype=dtype) for _ in range(6)]
+
+    _ddx(x, 0, grad)
+    _ddx(grad, 0, f11)
+    _ddx(grad, 1, f12)
+    _ddx(grad, 2, f13)
+    _ddx(x, 1, grad)
+    _ddx(grad, 1, f22)
+    _ddx(grad, 2, f23)
+    _ddx(x, 2, grad)
+    _ddx(grad, 2, f33)
     return [f11, f12, f13, f22, f23, f33]
 
 
-def bgtensor(img, lsigma, rho=0.2):
-    eps = 1e-12
-    fimg = fftn(img, overwrite_x=True)
+def _ddx(a, axis, out):
+    """
+    First derivative of a along axis written into out
+    Central differences inside and one-sided differences on the borders as np.gradient
+    """
+    xp = _get_array_module(a)
+    a = xp.moveaxis(a, axis, 0)
+    o = xp.moveaxis(out, axis, 0)
+    xp.subtract(a[2:], a[:-2], out=o[1:-1])
+    o[1:-1] *= 0.5
+    xp.subtract(a[1], a[0], out=o[0])
+    xp.subtract(a[-1], a[-2], out=o[-1])
+    return out
 
+
+def hessian_eig(x, out_b=None, out_j=None, out_d=None, backend='numpy'):
+    """
+    The eigenvalues of the hessian matrix of x at every voxel
+    Equals eigval33(hessian3(x), backend), but with backend='numba' the second derivatives
+    are computed voxel by voxel and fed to the closed form directly, so the six hessian
+    components are never stored
+    Parameters:
+       - x : 3D ndarray
+       - out_b, out_j, out_d : optional arrays of x.shape to write the eigenvalues into
+       - backend : as eigval33, the fused kernel is opt-in with 'numba'
+    Returns:
+       the three eigenvalue volumes (b, j, d) as eigval33
+    """
+    if backend != 'numba' or _get_array_module(x) is not np:
+        b, j, d = eigval33(hessian3(x), backend)
+        if out_b is None:
+            return b, j, d
+        out_b[...] = b
+        out_j[...] = j
+        out_d[...] = d
+        return out_b, out_j, out_d
+
+    if not HAS_NUMBA:
+        raise ImportError('numba is required to run hessian_eig with backend=%r' % (backend,))
+    x = np.ascontiguousarray(x, dtype=np.result_type(x.dtype, np.float32))
+    if out_b is None:
+        out_b, out_j, out_d = np.empty_like(x), np.empty_like(x), np.empty_like(x)
+    _hessian_eig_kernel(x, out_b, out_j, out_d)
+    return out_b, out_j, out_d
+
+
+if HAS_NUMBA:
+    @njit(cache=True)
+    def _neighbours(p, n):
+        '''
+        The neighbours of p along an axis of length n used by np.gradient
+        central inside and one-sided on the borders
+        '''
+        return (p - 1 if p > 0 else p), (p + 1 if p < n - 1 else p)
+
+
+    @njit(cache=True)
+    def _shifted(i, j, k, axis, p):
+        if axis == 0:
+            return p, j, k
+        elif axis == 1:
+            return i, p, k
+        return i, j, p
+
+
+    @njit(cache=True)
+    def _d1(x, i, j, k, axis):
+        '''
+        First derivative of x along axis at (i, j, k) as np.gradient
+        '''
+        lo, hi = _neighbours((i, j, k)[axis], x.shape[axis])
+        ilo, jlo, klo = _shifted(i, j, k, axis, lo)
+        ihi, jhi, khi = _shifted(i, j, k, axis, hi)
+        return (x[ihi, jhi, khi] - x[ilo, jlo, klo]) / x.dtype.type(hi - lo)
+
+
+    @njit(cache=True)
+    def _d2(x, i, j, k, axis1, axis2):
+        '''
+        The second derivative x_(axis1, axis2) at (i, j, k) as hessian3
+        '''
+        lo, hi = _neighbours((i, j, k)[axis2], x.shape[axis2])
+        ilo, jlo, klo = _shifted(i, j, k, axis2, lo)
+        ihi, jhi, khi = _shifted(i, j, k, axis2, hi)
+        return (_d1(x, ihi, jhi, khi, axis1) - _d1(x, ilo, jlo, klo, axis1)) / x.dtype.type(hi - lo)
+
+
+    @njit(parallel=True, fastmath=EIGVAL33_FASTMATH, cache=True)
+    def _hessian_eig_kernel(x, b, j, d):
+        f = x.dtype.type # Keep float32 volumes in single precision
+        two, four = f(2.), f(4.)
+        nx, ny, nz = x.shape
+        for p in prange(nx):
+            i = np.int64(p) # Keep the index arithmetic signed
+            for jj in range(ny):
+                for k in range(nz):
+                    if 2 <= i < nx - 2 and 2 <= jj < ny - 2 and 2 <= k < nz - 2:
+                        # Nested central differences away from the borders
+                        c = x[i, jj, k]
+                        f11 = (x[i + 2, jj, k] - two * c + x[i - 2, jj, k]) / four
+                        f22 = (x[i, jj + 2, k] - two * c + x[i, jj - 2, k]) / four
+                        f33 = (x[i, jj, k + 2] - two * c + x[i, jj, k - 2]) / four
+                        f12 = (x[i + 1, jj + 1, k] - x[i + 1, jj - 1, k] -
+                               x[i - 1, jj + 1, k] + x[i - 1, jj - 1, k]) / four
+                        f13 = (x[i + 1, jj, k + 1] - x[i + 1, jj, k - 1] -
+                               x[i - 1, jj, k + 1] + x[i - 1, jj, k - 1]) / four
+                        f23 = (x[i, jj + 1, k + 1] - x[i, jj + 1, k - 1] -
+                               x[i, jj - 1, k + 1] + x[i, jj - 1, k - 1]) / four
+                    else:
+                        f11 = _d2(x, i, jj, k, 0, 0)
+                        f12 = _d2(x, i, jj, k, 0, 1)
+                        f13 = _d2(x, i, jj, k, 0, 2)
+                        f22 = _d2(x, i, jj, k, 1, 1)
+                        f23 = _d2(x, i, jj, k, 1, 2)
+                        f33 = _d2(x, i, jj, k, 2, 2)
+                    b[i, jj, k], j[i, jj, k], d[i, jj, k] = _eigval33_scalar(
+                        f11, f12, f13, f22, f23, f33, f)
+
+
+def bgtensor(img, lsigma, rho=0.2, use_gpu=False):
+    eps = 1e-12
+    xp = _array_module(use_gpu)
+    fft, ifft = _real_fft_plans(img.shape, 'float32', use_gpu)
+    fimg = fft(xp.asarray(img, dtype='float32')) # Only the non-redundant half of the spectrum
+
+    # The kernels are zero padded to the image size to share the same plan
+    # and centred at the origin with wrap around, so the symmetric kernel
+    # has a real spectrum and the response is not shifted by the kernel radius
+    kernel = xp.zeros(img.shape, dtype='float32')
     for s in lsigma:
         jvbuffer = bgkern3(kerlen=math.ceil(s)*6+1, sigma=s, rho=rho)
-        jvbuffer = fftn(jvbuffer, shape=fimg.shape, overwrite_x=True) * fimg
-        fimg = ifftn(jvbuffer, overwrite_x=True)
-        yield hessian3(np.real(fimg))
-
-
-def eigval33(tensorfield):
-    ''' Calculate the eigenvalues of massive 3x3 real symmetric matrices. '''
-    a11, a12, a13, a22, a23, a33 = tensorfield  
-    eps = 1e-50
-    b = a11 + eps
-    d = a22 + eps
-    j = a33 + eps
-    c = - a12**2. - a13**2. - a23**2. + b * d + d * j + j* b 
-    d = - b * d * j + a23**2. * b + a12**2. * j - a13**2. * d + 2. * a13 * a12 * a23
-    b = - a11 - a22 - a33 - 3. * eps 
-    d = d + (2. * b**3. - 9. * b * c) / 27
-
-    c = b**2. / 3. - c
-    c = c**3.
-    c = c / 27
-    c[c < 0] = 0
-    c = np.sqrt(c)
-
-    j = c ** (1./3.) 
-    c = c + (c==0).astype('float')
-    d = -d /2. /c
-    d[d>1] = 1
-    d[d<-1] = 1
-    d = np.real(np.arccos(d) / 3.)
-    c = j * np.cos(d)
-    d = j * np.sqrt(3.) * np.sin(d)
-    b = -b / 3.
-
-    j = -c - d + b
-    d = -c + d + b
-    b = 2. * c + b
+        kr = jvbuffer.shape[0] // 2
+        half = [min(kr, (n - 1) // 2) for n in img.shape] # Crop the kernel to the image
+        kernel.fill(0)
+        kernel[xp.ix_(*[xp.arange(-h, h + 1) % n for h, n in zip(half, img.shape)])] = \
+            xp.asarray(jvbuffer[tuple(slice(kr - h, kr + h + 1) for h in half)])
+        jvbuffer = fft(kernel).real * fimg
+        yield hessian3(ifft(jvbuffer))
+
 
+def eigval33(tensorfield, backend='numpy'):
+    '''
+    Calculate the eigenvalues of massive 3x3 real symmetric matrices.
+    tensorfield: the six unique tensor components (f11, f12, f13, f22, f23, f33)
+                 either as a sequence or stacked as an array of shape (6,) + shape
+    backend: 'numpy', 'numba' or 'numexpr' for arrays on the CPU
+             the parallel numba and numexpr paths are opt-in
+    Arrays on the GPU always use a fused cupy kernel
+    '''
+    if _get_array_module(tensorfield[0]) is not np:
+        return _eigval33_fused(*tensorfield)
+
+    if backend not in ('numba', 'numexpr', 'numpy'):
+        raise ValueError('Unknown eigval33 backend %r' % (backend,))
+    if backend == 'numba' and not HAS_NUMBA or backend == 'numexpr' and not HAS_NUMEXPR:
+        raise ImportError('%s is required to run eigval33 with backend=%r' % (backend, backend))
+
+    # Work on raveled views of the components instead of stacking them into a copy
+    components = [np.asarray(a) for a in tensorfield]
+    shape = components[0].shape
+    dtype = np.result_type(*components, np.float32)
+    components = [a.astype(dtype, copy=False).ravel() for a in components]
+    if backend == 'numba':
+        evl = [np.empty_like(components[0]) for _ in range(3)]
+        _eigval33_kernel(*components, *evl)
+    elif backend == 'numexpr':
+        evl = _eigval33_numexpr(*components)
+    else:
+        evl = _eigval33_numpy(*components)
+    return tuple(e.reshape(shape) for e in evl)
+
+
+if HAS_NUMBA:
+    @njit(fastmath=EIGVAL33_FASTMATH, cache=True)
+    def _eigval33_scalar(a11, a12, a13, a22, a23, a33, f):
+        '''
+        The closed form of one voxel, f is the float type of the voxel
+        All the constants are typed by f so float32 voxels are solved in single precision
+        '''
+        eps = f(1e-20) # Does not underflow in float32
+        zero, one, two, three, nine, k27 = f(0.), f(1.), f(2.), f(3.), f(9.), f(27.)
+        p11 = a11 + eps
+        p22 = a22 + eps
+        p33 = a33 + eps
+        s12 = a12 * a12
+        s13 = a13 * a13
+        s23 = a23 * a23
+        c = - s12 - s13 - s23 + p11 * p22 + p22 * p33 + p33 * p11
+        q = - p11 * p22 * p33 + s23 * p11 + s12 * p33 + s13 * p22 - \
+            two * a13 * a12 * a23
+        s = - a11 - a22 - a33 - three * eps
+        q = q + (two * s * s * s - nine * s * c) / k27
+
+        c = s * s / three - c
+        c = c * c * c / k27
+        if c < zero:
+            c = zero
+        c = math.sqrt(c)
+
+        r = np.cbrt(c)
+        t = - q / two / c if c > zero else zero
+        if t > one:
+            t = one
+        elif t < - one:
+            t = - one
+        t = math.acos(t) / three
+        cc = r * math.cos(t)
+        dd = r * math.sqrt(three) * math.sin(t)
+        s = - s / three
+
+        return two * cc + s, - cc - dd + s, - cc + dd + s
+
+    @njit(parallel=True, fastmath=EIGVAL33_FASTMATH, cache=True)
+    def _eigval33_kernel(a11, a12, a13, a22, a23, a33, b, j, d):
+        '''
+        The same closed form as _eigval33_numpy on raveled components,
+        solved voxel by voxel in scalar registers
+        '''
+        f = b.dtype.type
+        for i in prange(a11.size):
+            b[i], j[i], d[i] = _eigval33_scalar(a11[i], a12[i], a13[i], a22[i], a23[i], a33[i], f)
+
+
+if HAS_CUPY:
+    @cupy.fuse()
+    def _eigval33_fused(a11, a12, a13, a22, a23, a33):
+        '''
+        The same closed form as _eigval33_numpy fused into one elementwise GPU kernel
+        '''
+        eps = 1e-20 # Does not underflow in float32
+        p11 = a11 + eps
+        p22 = a22 + eps
+        p33 = a33 + eps
+        c = - a12 * a12 - a13 * a13 - a23 * a23 + p11 * p22 + p22 * p33 + p33 * p11
+        q = - p11 * p22 * p33 + a23 * a23 * p11 + a12 * a12 * p33 + a13 * a13 * p22 - \
+            2. * a13 * a12 * a23
+        s = - a11 - a22 - a33 - 3. * eps
+        q = q + (2. * s * s * s - 9. * s * c) / 27.
+
+        c = s * s / 3. - c
+        c = cupy.sqrt(cupy.maximum(c * c * c / 27., 0.))
+        r = cupy.cbrt(c)
+        t = - q / 2. / cupy.where(c > 0., c, 1.)
+        t = cupy.arccos(cupy.minimum(cupy.maximum(t, -1.), 1.)) / 3.
+        cc = r * cupy.cos(t)
+        dd = r * math.sqrt(3.) * cupy.sin(t)
+        s = - s / 3.
+
+        return 2. * cc + s, - cc - dd + s, - cc + dd + s
+
+
+def _eigval33_numexpr(a11, a12, a13, a22, a23, a33):
+    '''
+    numexpr fallback of eigval33
+    Each step is evaluated as one fused multi-threaded pass without temporaries
+    '''
+    eps = a11.dtype.type(1e-20) # Does not underflow in float32
+    sqrt3 = a11.dtype.type(np.sqrt(3.))
+    s = ne.evaluate('- a11 - a22 - a33 - 3 * eps')
+    c = ne.evaluate('- a12**2 - a13**2 - a23**2 + (a11 + eps) * (a22 + eps) + '
+                    '(a22 + eps) * (a33 + eps) + (a33 + eps) * (a11 + eps)')
+    d = ne.evaluate('- (a11 + eps) * (a22 + eps) * (a33 + eps) + a23**2 * (a11 + eps) + '
+                    'a12**2 * (a33 + eps) + a13**2 * (a22 + eps) - 2 * a13 * a12 * a23 + '
+                    '(2 * s**3 - 9 * s * c) / 27')
+
+    ne.evaluate('(s**2 / 3 - c)**3 / 27', out=c)
+    ne.evaluate('sqrt(where(c > 0, c, 0))', out=c)
+    j = np.cbrt(c) # numexpr has no cube root
+
+    # d = arccos(clip(- d / 2 / c, -1, 1)) / 3, it is irrelevant where c == 0 since j is 0 there
+    ne.evaluate('where(c > 0, - d / 2 / where(c > 0, c, 1), 0)', out=d)
+    ne.evaluate('arccos(where(d > 1, 1, where(d < -1, -1, d))) / 3', out=d)
+    ne.evaluate('j * cos(d)', out=c)
+    ne.evaluate('j * sqrt3 * sin(d)', out=d)
+
+    b = ne.evaluate('2 * c - s / 3')
+    ne.evaluate('- c - d - s / 3', out=j)
+    ne.evaluate('- c + d - s / 3', out=d)
     return b, j, d
 
 
+def _eigval33_numpy(a11, a12, a13, a22, a23, a33):
+    '''
+    NumPy fallback of eigval33 on raveled components
+    The voxels are swept block by block so each block stays in cache
+    while the closed form makes its passes over it
+    '''
+    nvox = a11.size
+    b = np.empty_like(a11)
+    j = np.empty_like(a11)
+    d = np.empty_like(a11)
+    scratch = np.empty((3, min(nvox, EIGVAL33_TILE)), dtype=a11.dtype)
+
+    for start in range(0, nvox, EIGVAL33_TILE):
+        block = slice(start, start + EIGVAL33_TILE)
+        ntile = min(EIGVAL33_TILE, nvox - start)
+        _eigval33_tile(a11[block], a12[block], a13[block], a22[block], a23[block], a33[block],
+                       b[block], j[block], d[block], *scratch[:, :ntile])
+
+    return b, j, d
+
+
+def _eigval33_tile(a11, a12, a13, a22, a23, a33, b, j, d, c, q, tmp):
+    '''
+    Solve one block of eigval33 in place
+    b, j, d receive the eigenvalues; c, q, tmp are scratch buffers of the same size
+    '''
+    eps = 1e-20 # Does not underflow in float32
+    np.add(a11, eps, out=b)
+    np.add(a22, eps, out=d)
+    np.add(a33, eps, out=j)
+
+    # c = - a12**2 - a13**2 - a23**2 + b * d + d * j + j * b
+    np.multiply(b, d, out=c)
+    np.multiply(d, j, out=tmp)
+    c += tmp
+    np.multiply(j, b, out=tmp)
+    c += tmp
+    for a in (a12, a13, a23):
+        np.square(a, out=tmp)
+        c -= tmp
+
+    # q = - b * d * j + a23**2 * b + a12**2 * j + a13**2 * d - 2 * a13 * a12 * a23
+    np.square(a23, out=q)
+    q *= b
+    np.square(a12, out=tmp)
+    tmp *= j
+    q += tmp
+    np.square(a13, out=tmp)
+    tmp *= d
+    q += tmp
+    np.multiply(a13, a12, out=tmp)
+    tmp *= a23
+    tmp *= 2.
+    q -= tmp
+    np.multiply(b, d, out=tmp)
+    tmp *= j
+    q -= tmp
+
+    # b = - a11 - a22 - a33 - 3 * eps
+    np.add(a11, a22, out=b)
+    b += a33
+    b += 3. * eps
+    np.negative(b, out=b)
+
+    # d = q + (2 * b**3 - 9 * b * c) / 27
+    np.square(b, out=tmp)
+    tmp *= 2.
+    np.multiply(c, 9., out=d)
+    tmp -= d
+    tmp *= b
+    tmp /= 27.
+    np.add(q, tmp, out=d)
+
+    # c = sqrt(max((b**2 / 3 - c)**3 / 27, 0))
+    np.square(b, out=tmp)
+    tmp /= 3.
+    np.subtract(tmp, c, out=c)
+    np.power(c, 3., out=c)
+    c /= 27.
+    np.maximum(c, 0., out=c)
+    np.sqrt(c, out=c)
+
+    np.cbrt(c, out=j)
+    # d = - d / 2 / c, it is irrelevant where c == 0 since j is 0 there
+    d *= -0.5
+    np.divide(d, c, out=d, where=c > 0)
+    np.clip(d, -1., 1., out=d)
+
+    # c = j * cos(arccos(d) / 3); d = j * sqrt(3) * sin(arccos(d) / 3)
+    np.arccos(d, out=d)
+    d /= 3.
+    np.cos(d, out=c)
+    c *= j
+    np.sin(d, out=d)
+    d *= np.sqrt(3.)
+    d *= j
+    b /= -3.
+
+    # j = - c - d + b; d = - c + d + b; b = 2 * c + b
+    np.subtract(b, c, out=q)
+    np.subtract(q, d, out=j)
+    np.add(q, d, out=d)
+    c *= 2.
+    b += c
+
+
 def oofftkernel(kernel_radius, r, sigma=1, ntype=1):
     eps = 1e-12
+    xp = _get_array_module(kernel_radius)
+    r = float(r) # Keep the dtype of kernel_radius
     normalisation = 4/3 * np.pi * r**3 / (jv(1.5, 2*np.pi*r*eps) / eps ** (3/2)) / r**2 *  \
-                    (r / np.sqrt(2.*r*sigma - sigma**2)) ** ntype
-    jvbuffer = normalisation * np.exp( (-2 * sigma**2 * np.pi**2 * kernel_radius**2) / (kernel_radius**(3/2) ))
-    return (np.sin(2 * np.pi * r * kernel_radius) / (2 * np.pi * r * kernel_radius) - np.cos(2 * np.pi * r * kernel_radius)) * \
-               jvbuffer * np.sqrt( 1./ (np.pi**2 * r *kernel_radius ))
+                    (r / math.sqrt(2.*r*sigma - sigma**2)) ** ntype
+    normalisation = float(normalisation)
+    jvbuffer = normalisation * xp.exp( (-2 * sigma**2 * np.pi**2 * kernel_radius**2) / (kernel_radius**(3/2) ))
+    return (xp.sin(2 * np.pi * r * kernel_radius) / (2 * np.pi * r * kernel_radius) - xp.cos(2 * np.pi * r * kernel_radius)) * \
+               jvbuffer * xp.sqrt( 1./ (np.pi**2 * r *kernel_radius ))
 
 
-def ooftensor(img, radii, memory_save=True):
+def ooftensor(img, radii, memory_save=True, use_gpu=False):
     '''
     type: oof, bg
     '''
     # sigma = 1 # TODO: Pixel spacing
     eps = 1e-12
     # ntype = 1 # The type of normalisation
-    fimg = fftn(img, overwrite_x=True)
-    shiftmat = ifftshiftedcoormatrix(fimg.shape)
-    x, y, z = shiftmat
-    x = x / fimg.shape[0]
-    y = y / fimg.shape[1]
-    z = z / fimg.shape[2]
-    kernel_radius = np.sqrt(x ** 2 + y ** 2 + z ** 2) + eps # The distance from origin
-
+    xp = _array_module(use_gpu)
+    fft, ifft = _real_fft_plans(img.shape, 'float32', use_gpu)
+    fimg = fft(xp.asarray(img, dtype='float32')) # Only the non-redundant half of the spectrum
+    nhalf = fimg.shape[2]
+
+    # Restrict the coordinates to the half spectrum along the last axis
+    x, y, z = [xp.asarray(c[:, :, :nhalf] / n, dtype='float32')
+               for c, n in zip(ifftshiftedcoormatrix(img.shape), img.shape)]
+    kernel_radius = xp.sqrt(x ** 2 + y ** 2 + z ** 2) + eps # The distance from origin
+
+    # The radius independent weights of the six tensor components
+    if memory_save:
+        cx = xp.asarray(ifftshiftedcoordinate(img.shape, 0)[:, :, :nhalf], dtype='float32')
+        cy = xp.asarray(ifftshiftedcoordinate(img.shape, 1)[:, :, :nhalf], dtype='float32')
+        cz = xp.asarray(ifftshiftedcoordinate(img.shape, 2)[:, :, :nhalf], dtype='float32')
+        weights = [cx * cx * x * x, cx * cy * x * y, cx * cz * x * z,
+                   cy * cy * y * y, cy * cz * y * z, cz * cz * z * z]
+        del cx, cy, cz
+    else:
+        # The Nyquist bin of an even axis has no Hermitian partner, so the real part
+        # of an odd cross term only keeps it where both of its factors are unpaired
+        unpaired = []
+        for axis, (c, n) in enumerate(zip((x, y, z), img.shape)):
+            u = xp.zeros_like(c)
+            if n % 2 == 0:
+                nyquist = tuple(n // 2 if a == axis else slice(None) for a in range(3))
+                u[nyquist] = c[nyquist]
+            unpaired.append(u)
+        ux, uy, uz = unpaired
+        px, py, pz = x - ux, y - uy, z - uz
+        weights = [x * x, px * py + ux * uy, px * pz + ux * uz, y * y, py * pz + uy * uz, z * z]
+        del unpaired, ux, uy, uz, px, py, pz
+
+    jvbuffer = xp.empty_like(fimg)
+    buffer = xp.empty_like(fimg)
     for r in radii:
         # Make the fourier convolutional kernel
-        jvbuffer = oofftkernel(kernel_radius, r) * fimg
-
-        if memory_save:
-            # F11
-            buffer = ifftshiftedcoordinate(img.shape, 0) ** 2 * x * x * jvbuffer
-            buffer = ifft(buffer, axis=0)
-            buffer = ifft(buffer, axis=1)
-            buffer = ifft(buffer, axis=2)
-            f11 = buffer.copy()
-
-            # F12
-            buffer = ifftshiftedcoordinate(img.shape, 0) * ifftshiftedcoordinate(img.shape, 1) * x * y * jvbuffer
-            buffer = ifft(buffer, axis=0)
-            buffer = ifft(buffer, axis=1)
-            buffer = ifft(buffer, axis=2)
-            f12 = buffer.copy()
-
-            # F13
-            buffer = ifftshiftedcoordinate(img.shape, 0) * ifftshiftedcoordinate(img.shape, 2) * x * z * jvbuffer
-            buffer = ifft(buffer, axis=0)
-            buffer = ifft(buffer, axis=1)
-            buffer = ifft(buffer, axis=2)
-            f13 = buffer.copy()
-
-            # F22
-            buffer = ifftshiftedcoordinate(img.shape, 1) ** 2 * y ** 2 * jvbuffer
-            buffer = ifft(buffer, axis=0)
-            buffer = ifft(buffer, axis=1)
-            buffer = ifft(buffer, axis=2)
-            f22 = buffer.copy()
-
-            # F23
-            buffer = ifftshiftedcoordinate(img.shape, 1) * ifftshiftedcoordinate(img.shape, 2) * y * z * jvbuffer
-            buffer = ifft(buffer, axis=0)
-            buffer = ifft(buffer, axis=1)
-            buffer = ifft(buffer, axis=2)
-            f23 = buffer.copy()
-
-            # F33
-            buffer = ifftshiftedcoordinate(img.shape, 2) * ifftshiftedcoordinate(img.shape, 2) * z * z * jvbuffer
-            buffer = ifft(buffer, axis=0)
-            buffer = ifft(buffer, axis=1)
-            buffer = ifft(buffer, axis=2)
-            f33 = buffer.copy()
-        else:
-            f11 = np.real(ifftn(x * x * jvbuffer))
-            f12 = np.real(ifftn(x * y * jvbuffer))
-            f13 = np.real(ifftn(x * z * jvbuffer))
-            f22 = np.real(ifftn(y * y * jvbuffer))
-            f23 = np.real(ifftn(y * z * jvbuffer))
-            f33 = np.real(ifftn(z * z * jvbuffer))
-        yield [f11, f12, f13, f22, f23, f33]
+        xp.multiply(oofftkernel(kernel_radius, r), fimg, out=jvbuffer)
+
+        tensorfield = []
+        for w in weights:
+            xp.multiply(w, jvbuffer, out=buffer)
+            tensorfield.append(ifft(buffer))
+        yield tensorfield
+
+
+def _array_module(use_gpu=False):
+    '''
+    Get the array module for the CPU or the GPU
+    '''
+    if not use_gpu:
+        return np
+    if not HAS_CUPY:
+        raise ImportError('cupy is required to run the anisotropic filters with use_gpu=True')
+    return cupy
+
+
+def _real_fft_plans(shape, dtype, use_gpu=False):
+    '''
+    Make the forward and the inverse real FFT of volumes with the given shape
+    With pyFFTW the plans are built once and reused for every call
+    '''
+    axes = tuple(range(len(shape)))
+    if use_gpu or not HAS_PYFFTW:
+        xp = _array_module(use_gpu)
+        return (lambda a: xp.fft.rfftn(a, s=shape, axes=axes)), \
+               (lambda a: xp.fft.irfftn(a, s=shape, axes=axes))
+
+    threads = os.cpu_count()
+    fft = pyfftw.builders.rfftn(pyfftw.empty_aligned(shape, dtype=dtype), axes=axes,
+                                threads=threads, planner_effort=FFTW_PLANNER_EFFORT)
+    ifft = pyfftw.builders.irfftn(pyfftw.empty_aligned(fft.output_shape, dtype=fft.output_dtype),
+                                  s=shape, axes=axes, threads=threads, planner_effort=FFTW_PLANNER_EFFORT)
+    _save_fftw_wisdom()
+
+    # The plans return their internal output arrays which are overwritten by the next call.
+    # The inverse writes each result into a new aligned array instead of copying it out;
+    # its inputs are always scratch spectra, which the c2r transform is free to destroy
+    return (lambda a: fft(a).copy()), \
+           (lambda a: ifft(a, output_array=pyfftw.empty_aligned(shape, dtype=ifft.output_dtype)))
+
+
+def _load_fftw_wisdom():
+    '''
+    Import the FFTW wisdom saved by a previous run if there is any
+    The three wisdom strings (double, single, long double) are stored separated by NUL
+    '''
+    global _saved_wisdom
+    try:
+        with open(FFTW_WISDOM_FILE, 'rb') as f:
+            wisdom = tuple(f.read().split(b'\0'))
+    except OSError:
+        return
+    if len(wisdom) == 3:
+        pyfftw.import_wisdom(wisdom)
+        _saved_wisdom = pyfftw.export_wisdom()
+
+
+def _save_fftw_wisdom():
+    '''
+    Write the FFTW wisdom back to disk when planning has added to it
+    '''
+    global _saved_wisdom
+    wisdom = pyfftw.export_wisdom()
+    if wisdom == _saved_wisdom:
+        return
+    try:
+        tmpfile = FFTW_WISDOM_FILE + '.%d' % os.getpid()
+        with open(tmpfile, 'wb') as f:
+            f.write(b'\0'.join(wisdom))
+        os.replace(tmpfile, FFTW_WISDOM_FILE) # Never leave a half written file behind
+        _saved_wisdom = wisdom
+    except OSError:
+        pass # The wisdom is only a cache, planning still works without it
+
+
+_saved_wisdom = None
+if HAS_PYFFTW:
+    _load_fftw_wisdom()
+
+
+def _get_array_module(a):
+    return cupy.get_array_module(a) if HAS_CUPY else np
+
+
+def _asnumpy(a):
+    return cupy.asnumpy(a) if HAS_CUPY else a
 
 
 # The dimension is a vector specifying the size of the returned coordinate
 # matrices. The number of output argument is equals to the dimensionality
 # of the vector "dimension". All the dimension is starting from "1"
+# Each coordinate is returned with singleton dimensions on the other axes
+# (e.g. (nx, 1, 1)) so it broadcasts against the full volume without tiling
 def ifftshiftedcoormatrix(shape):
     shape = np.asarray(shape)
     p = np.floor(np.asarray(shape) / 2).astype('int')
     coord = []
     for i in range(shape.size):
-        a = np.hstack((np.arange(p[i], shape[i]), np.arange(0, p[i]))) - p[i] - 1.
-        repmatpara = np.ones((shape.size,)).astype('int')
-        repmatpara[i] = shape[i]
-        A = a.reshape(repmatpara)
-        repmatpara = shape.copy()
-        repmatpara[i] = 1
-        coord.append(np.tile(A, repmatpara))
+        a = (np.hstack((np.arange(p[i], shape[i]), np.arange(0, p[i]))) - p[i]).astype('float')
+        reshapepara = np.ones((shape.size,)).astype('int')
+        reshapepara[i] = shape[i]
+        coord.append(a.reshape(reshapepara))
 
     return coord
 
@@ -340,14 +824,11 @@ def ifftshiftedcoormatrix(shape):
 def ifftshiftedcoordinate(shape, axis):
     shape = np.asarray(shape)
     p = np.floor(np.asarray(shape) / 2).astype('int')
-    a = (np.hstack((np.arange(p[axis], shape[axis]), np.arange(0, p[axis]))) - p[axis] - 1.).astype('float')
+    a = (np.hstack((np.arange(p[axis], shape[axis]), np.arange(0, p[axis]))) - p[axis]).astype('float')
     a /= shape[axis].astype('float')
-    reshapepara = np.ones((shape.size,)).astype('float');
-    reshapepara[axis] = shape[axis];
-    A = a.reshape(reshapepara);
-    repmatpara = shape.copy();
-    repmatpara[axis] = 1;
-    return np.tile(A, repmatpara)
+    reshapepara = np.ones((shape.size,)).astype('int')
+    reshapepara[axis] = shape[axis]
+    return a.reshape(reshapepara) # Broadcastable against the full volume
 
 
 def nonmaximal_suppression3(img, evl, evt, radius, threshold=0):
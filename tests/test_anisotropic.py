@@ -0,0 +1,90 @@
+import math
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from filtering import anisotropic
+
+BACKENDS = ['numpy'] + (['numba'] if anisotropic.HAS_NUMBA else []) + \
+           (['numexpr'] if anisotropic.HAS_NUMEXPR else [])
+
+
+def _eigvalsh(tensorfield):
+    f11, f12, f13, f22, f23, f33 = np.asarray(tensorfield, dtype=np.float64)
+    m = np.stack([f11, f12, f13, f12, f22, f23, f13, f23, f33], -1)
+    return np.linalg.eigvalsh(m.reshape(f11.shape + (3, 3)))
+
+
+def _sorted(evl):
+    return np.sort(np.stack(evl, -1), -1)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('dtype, rtol', [(np.float64, 1e-10), (np.float32, 1e-4)])
+def test_eigval33_matches_eigvalsh(backend, dtype, rtol):
+    tensorfield = np.random.RandomState(0).randn(6, 9, 10, 11).astype(dtype)
+    expected = _eigvalsh(tensorfield)
+    for inp in (tensorfield, list(tensorfield)):
+        evl = anisotropic.eigval33(inp, backend=backend)
+        assert all(e.shape == (9, 10, 11) and e.dtype == dtype for e in evl)
+        np.testing.assert_allclose(_sorted(evl), expected, rtol=0, atol=rtol * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_eigval33_degenerate(backend, dtype):
+    zeros = np.zeros((6, 4, 5), dtype=dtype)
+    np.testing.assert_allclose(_sorted(anisotropic.eigval33(zeros, backend=backend)), 0, atol=1e-6)
+
+    isotropic = np.zeros((6, 4, 5), dtype=dtype)
+    isotropic[[0, 3, 5]] = 2
+    np.testing.assert_allclose(_sorted(anisotropic.eigval33(isotropic, backend=backend)), 2, atol=1e-5)
+
+
+def test_eigval33_unknown_backend():
+    with pytest.raises(ValueError):
+        anisotropic.eigval33(np.zeros((6, 2)), backend='fortran')
+
+
+def _full_spectrum_tensor(img, r, memory_save):
+    X, Y, Z = np.meshgrid(*[np.fft.fftfreq(n) for n in img.shape], indexing='ij')
+    jvbuffer = anisotropic.oofftkernel(np.sqrt(X ** 2 + Y ** 2 + Z ** 2) + 1e-12, r) * np.fft.fftn(img)
+    if memory_save:
+        X, Y, Z = X * X, Y * Y, Z * Z
+    weights = [X * X, X * Y, X * Z, Y * Y, Y * Z, Z * Z]
+    return [np.real(np.fft.ifftn(w * jvbuffer)) for w in weights]
+
+
+@pytest.mark.parametrize('shape', [(9, 10, 11), (20, 21, 22), (9, 11, 13)])
+@pytest.mark.parametrize('memory_save', [False, True])
+def test_ooftensor_matches_full_spectrum(shape, memory_save):
+    img = np.random.RandomState(0).rand(*shape)
+    tensorfield = next(anisotropic.ooftensor(img, [1.5], memory_save))
+    for f, expected in zip(tensorfield, _full_spectrum_tensor(img, 1.5, memory_save)):
+        assert f.shape == shape
+        np.testing.assert_allclose(f, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('shape', [(20, 21, 22), (9, 10, 11)]) # The kernel is cropped to (9, 10, 11)
+def test_bgtensor_matches_wrapped_convolution(shape):
+    img = np.random.RandomState(0).rand(*shape)
+    sigma = 1.5
+    kernel = anisotropic.bgkern3(kerlen=math.ceil(sigma) * 6 + 1, sigma=sigma, rho=0.2)
+    kr = kernel.shape[0] // 2
+    kernel = kernel[tuple(slice(kr - h, kr + h + 1) for h in [min(kr, (n - 1) // 2) for n in shape])]
+    expected = anisotropic.hessian3(ndimage.convolve(img, kernel, mode='wrap'))
+    tensorfield = next(anisotropic.bgtensor(img, [sigma], 0.2))
+    assert len(tensorfield) == len(expected) == 6
+    for f, e in zip(tensorfield, expected):
+        np.testing.assert_allclose(f, e, rtol=0, atol=1e-5 * np.abs(e).max())
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('dtype, atol', [(np.float64, 1e-12), (np.float32, 1e-5)])
+def test_hessian_eig_matches_eigval33(backend, dtype, atol):
+    x = np.random.RandomState(0).rand(9, 10, 11).astype(dtype)
+    expected = anisotropic.eigval33(anisotropic.hessian3(x))
+    for e, expected_e in zip(anisotropic.hessian_eig(x, backend=backend), expected):
+        assert e.dtype == dtype
+        np.testing.assert_allclose(e, expected_e, rtol=0, atol=atol)